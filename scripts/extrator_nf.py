@@ -1,8 +1,25 @@
 import pdfplumber
+import pypdfium2 as pdfium
 import re
 import os
+
+try:
+    # Opcional: o RE2 do Google casa em tempo linear (DFA), sem o
+    # backtracking do re. Os padrões de extração não usam backreference
+    # nem lookaround, então são todos elegíveis.
+    import re2 as _re_motor
+except ImportError:
+    _re_motor = re
+import csv
+import hashlib
+import mmap
+import orjson
+import shelve
 import pandas as pd
+import xlsxwriter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from itertools import islice
 import logging
 from pathlib import Path
 
@@ -44,8 +61,8 @@ def configurar_ambiente():
 # 2. DEFINIÇÃO DOS PADRÕES DE EXTRAÇÃO
 # ==============================================
 def carregar_padroes():
-    """Retorna os padrões de regex para extração"""
-    return {
+    """Retorna os padrões de regex para extração, já compilados"""
+    padroes = {
         'numero_nota': [
             r'NFS-e\s*n°\s*(\d+\.\d+)',
             r'Nota Fiscal Eletrônica\s*N°\s*(\d+\.\d+)'
@@ -54,17 +71,21 @@ def carregar_padroes():
             r'Data e Hora de Emissão\s*(\d{2}/\d{2}/\d{4}\s*\d{2}:\d{2}:\d{2})',
             r'emitida em\s*(\d{2}/\d{2}/\d{4})'
         ],
+        # Saltos entre âncoras usam [\s\S]{0,N}? (atravessa linhas, mas
+        # limitado) e valores capturados usam [^\n]{0,N}? (uma linha só):
+        # quantificadores limitados evitam o retrocesso do ".*?" sobre a
+        # página inteira e dispensam o re.DOTALL.
         'cnpj_prestador': [
-            r'PRESTADOR DE SERVIÇOS.*?CPF/CNPJ\s*([\d./-]+)'
+            r'PRESTADOR DE SERVIÇOS[\s\S]{0,200}?CPF/CNPJ\s*([\d./-]+)'
         ],
         'nome_prestador': [
-            r'Nome/Razão Social:\s*(.*?)\s*Endereço'
+            r'(?i:Nome/Razão Social:)\s*([^\n]{0,200}?)\s*Endereço'
         ],
         'cnpj_tomador': [
-            r'TOMADOR DE SERVIÇOS.*?C\.P\.F\./C\.N\.P\.J\.\s*([\d./-]+)'
+            r'TOMADOR DE SERVIÇOS[\s\S]{0,200}?C\.P\.F\./C\.N\.P\.J\.\s*([\d./-]+)'
         ],
         'nome_tomador': [
-            r'TOMADOR DE SERVIÇOS.*?Nome/Razão Social:\s*(.*?)\s*C\.P\.F\./C\.N\.P\.J\.'
+            r'TOMADOR DE SERVIÇOS[\s\S]{0,200}?(?i:Nome/Razão Social:)\s*([^\n]{0,200}?)\s*C\.P\.F\./C\.N\.P\.J\.'
         ],
         'valor_total': [
             r'VALOR TOTAL DOS SERVIÇOS\s*=\s*R\$\s*([\d.,]+)',
@@ -83,59 +104,193 @@ def carregar_padroes():
             r'Município da Prestação de Serviços\s*(\d+\s*-\s*[^/]+/[A-Z]{2})'
         ]
     }
+    # Compila uma única vez no carregamento: evita a busca no cache interno
+    # do módulo re a cada campo de cada PDF. Os padrões já soletram a
+    # capitalização exata das notas; IGNORECASE (case-folding por caractere)
+    # fica restrito aos rótulos com grafia variável, via (?i:...) acima.
+    flags = re.MULTILINE
+    return {
+        campo: [_re_motor.compile(p, flags) for p in lista]
+        for campo, lista in padroes.items()
+    }
 
 # ==============================================
 # 3. FUNÇÕES DE PROCESSAMENTO
 # ==============================================
+def hash_arquivo(caminho):
+    """Impressão digital do conteúdo do arquivo (BLAKE2b, 128 bits)"""
+    with open(caminho, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+# Localiza o grupo de captura "(" de um padrão (ignora "\(" e "(?:")
+_GRUPO_CAPTURA = re.compile(r'(?<!\\)\((?!\?)')
+
+# "1.234,56" -> "1234.56" em uma única passada, sem strings intermediárias
+_NUM_TR = str.maketrans({'.': '', ',': '.'})
+
 class ProcessadorPDF:
     def __init__(self, padroes):
         self.padroes = padroes
-    
+        self.padrao_combinado = self._combinar_padroes(padroes)
+        # Calculado uma vez na construção: o teste por substring rodava
+        # quatro vezes por campo por PDF. Reproduz o critério original,
+        # inclusive 'data_emissao' (que contém "iss").
+        self._campos_numericos = frozenset(
+            campo for campo in padroes
+            if any(chave in campo for chave in ('valor', 'iss', 'base', 'aliquota'))
+        )
+
+    @staticmethod
+    def _combinar_padroes(padroes):
+        """Une todos os padrões em uma única alternância de grupos nomeados
+
+        Uma varredura de finditer substitui as ~11 varreduras por campo.
+        O grupo de captura de cada padrão vira um grupo nomeado
+        'campo__indice', recuperado via match.lastgroup.
+        """
+        alternativas = [
+            _GRUPO_CAPTURA.sub(f'(?P<{campo}__{i}>', pat.pattern, count=1)
+            for campo, lista in padroes.items()
+            for i, pat in enumerate(lista)
+        ]
+        flags = re.MULTILINE
+        return _re_motor.compile('|'.join(alternativas), flags)
+
+    def extrair_todos(self, texto):
+        """Extrai todos os campos possíveis em uma única varredura do texto"""
+        valores = {}
+        for match in self.padrao_combinado.finditer(texto):
+            grupo = match.lastgroup
+            if grupo is None:
+                continue
+            campo = grupo.rsplit('__', 1)[0]
+            # Captura vazia (rótulo sem valor ao lado) não conta como
+            # extração: deixa o campo livre para os fallbacks por padrão,
+            # por página e via pdfplumber preencherem depois.
+            valor = match.group(grupo).strip()
+            if valor and campo not in valores:
+                valores[campo] = valor
+        return valores
+
+
     def limpar_valor(self, valor):
         """Converte valores para float, tratando casos especiais"""
-        if valor in (None, '', '0,00'):
+        if not valor or valor == '0,00':
             return 0.0
         try:
-            return float(valor.replace('.', '').replace(',', '.'))
+            # Caminho rápido: sem separador brasileiro não há o que
+            # traduzir — float() aceita a string como está, sem alocar
+            # uma cópia.
+            if ',' in valor or '.' in valor:
+                return float(valor.translate(_NUM_TR))
+            return float(valor)
         except ValueError:
-            logging.warning(f"Valor não numérico: {valor}")
+            logging.warning("Valor não numérico: %s", valor)
             return 0.0
     
     def extrair_info(self, texto, padroes):
-        """Tenta extrair informação usando múltiplos padrões"""
-        for padrao in (padroes if isinstance(padroes, list) else [padroes]):
+        """Tenta extrair informação usando múltiplos padrões compilados"""
+        for padrao in padroes:
             try:
-                match = re.search(padrao, texto, re.IGNORECASE | re.MULTILINE | re.DOTALL)
+                match = padrao.search(texto)
                 if match:
                     return match.group(1).strip()
             except Exception as e:
-                logging.error(f"Erro no padrão {padrao}: {str(e)}")
+                logging.error("Erro no padrão %s: %s", padrao.pattern, e)
         return None
     
+    @staticmethod
+    def _paginas_pdfium(caminho_pdf):
+        """Gera o texto de cada página via pypdfium2 (sem reconstrução de layout)"""
+        pdf = pdfium.PdfDocument(caminho_pdf)
+        try:
+            for pagina in pdf:
+                yield pagina.get_textpage().get_text_range()
+        finally:
+            pdf.close()
+
+    @staticmethod
+    def _extrair_texto_pdfplumber(caminho_pdf):
+        """Extrai texto com a reconstrução de layout do pdfplumber (lenta)"""
+        # Sem laparams: o padrão (None) desliga a análise de layout do
+        # pdfminer por completo — passar qualquer dict a reativaria.
+        # mmap no lugar de read(): o SO pagina só os trechos que o parser
+        # realmente toca, em vez de manter o arquivo inteiro em RAM por
+        # worker — relevante com vários processos abertos ao mesmo tempo.
+        with open(caminho_pdf, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                pdfplumber.open(mm) as pdf:
+            partes = []
+            for page in pdf.pages:
+                # Uma única chamada por página: extract_text refaz todo o
+                # agrupamento de caracteres a cada invocação.
+                texto = page.extract_text(x_tolerance=2, y_tolerance=2)
+                if texto:
+                    partes.append(texto)
+                # Libera chars/objetos da página já consumida para que a
+                # memória não cresça com o número de páginas.
+                page.flush_cache()
+            return "\n".join(partes)
+
+    def extrair_valores(self, texto):
+        """Extrai os valores brutos de todos os campos do texto
+
+        Varredura única com o padrão combinado; os campos que a
+        alternância não alcançou (âncoras de seção sobrepostas) caem no
+        caminho padrão campo a campo.
+        """
+        valores = self.extrair_todos(texto)
+        for campo, padroes in self.padroes.items():
+            if campo not in valores:
+                valor = self.extrair_info(texto, padroes)
+                if valor:
+                    valores[campo] = valor
+        return valores
+
     def processar_pdf(self, caminho_pdf):
         """Processa um arquivo PDF e retorna dict com dados"""
         try:
-            with pdfplumber.open(caminho_pdf) as pdf:
-                texto = "\n".join(
-                    page.extract_text(x_tolerance=2, y_tolerance=2)
-                    for page in pdf.pages
-                    if page.extract_text()
-                )
-            
-            if not texto:
-                logging.warning(f"Arquivo sem texto extraível: {caminho_pdf}")
-                return None
-            
-            # Debug: visualizar texto extraído (útil para ajustar regex)
-            logging.debug(f"Texto extraído de {os.path.basename(caminho_pdf)}:\n{texto[:500]}...")
-            
+            # pypdfium2 entrega o texto direto, sem o agrupamento de
+            # caracteres/bboxes do pdfplumber — suficiente para os regex.
+            # As NFS-e costumam ter todos os campos na primeira página:
+            # processa página a página e para assim que tudo casou.
+            valores = {}
+            for texto in self._paginas_pdfium(caminho_pdf):
+                if not texto:
+                    continue
+                for campo, valor in self.extrair_valores(texto).items():
+                    valores.setdefault(campo, valor)
+                if len(valores) == len(self.padroes):
+                    break
+
+            # A ordem de leitura do texto cru pode separar rótulo e valor
+            # (e alguns layouts só casam com a reconstrução do pdfplumber):
+            # se sobrou campo sem valor, reextrai e mescla os resultados,
+            # mantendo o que o pypdfium2 já encontrou.
+            if len(valores) < len(self.padroes):
+                texto = self._extrair_texto_pdfplumber(caminho_pdf)
+                if not texto and not valores:
+                    logging.warning("Arquivo sem texto extraível: %s", caminho_pdf)
+                    return None
+
+                if texto:
+                    # Debug: visualizar texto extraído (útil para ajustar
+                    # regex). Guardado pelo nível para não formatar à toa.
+                    if logging.getLogger().isEnabledFor(logging.DEBUG):
+                        logging.debug("Texto extraído de %s:\n%.500s...",
+                                      os.path.basename(caminho_pdf), texto)
+
+                    for campo, valor in self.extrair_valores(texto).items():
+                        valores.setdefault(campo, valor)
+
             dados = {'arquivo': os.path.basename(caminho_pdf)}
-            
-            for campo, padroes in self.padroes.items():
-                valor = self.extrair_info(texto, padroes)
-                
+
+            for campo in self.padroes:
+                valor = valores.get(campo)
+
                 # Conversão especial por tipo de campo
-                if any(key in campo for key in ['valor', 'iss', 'base', 'aliquota']):
+                if campo in self._campos_numericos:
                     dados[campo] = self.limpar_valor(valor)
                 else:
                     dados[campo] = valor if valor else ""
@@ -143,97 +298,205 @@ class ProcessadorPDF:
             return dados
         
         except Exception as e:
-            logging.error(f"Erro ao processar {caminho_pdf}: {str(e)}")
+            logging.error("Erro ao processar %s: %s", caminho_pdf, e)
             return None
 
 # ==============================================
 # 4. GERADOR DE RELATÓRIOS
 # ==============================================
 class GeradorRelatorio:
+    COLUNAS = [
+        'arquivo', 'numero_nota', 'data_emissao',
+        'cnpj_prestador', 'nome_prestador',
+        'cnpj_tomador', 'nome_tomador',
+        'valor_total', 'base_calculo', 'iss', 'aliquota_iss',
+        'municipio_prestacao'
+    ]
+    CAMPOS_NUMERICOS = {'valor_total', 'base_calculo', 'iss', 'aliquota_iss'}
+
     def __init__(self, config):
         self.config = config
+        # XLSX (XML + ZIP) é o formato mais caro de serializar; para lotes
+        # grandes, FORMATO_SAIDA=csv troca por escrita direta em texto.
+        self.formato = os.environ.get('FORMATO_SAIDA', 'xlsx').lower()
         self.saida_arquivo = os.path.join(
-            config['SAIDA_DIR'], 
-            f'dados_extraidos_{datetime.now().strftime("%Y%m%d_%H%M")}.xlsx'
+            config['SAIDA_DIR'],
+            f'dados_extraidos_{datetime.now().strftime("%Y%m%d_%H%M")}.{self.formato}'
         )
-    
-    def gerar_excel(self, registros):
-        """Gera relatório final em Excel"""
-        if not registros:
+        # NDJSON intermediário: os registros são gravados linha a linha
+        # conforme cada PDF termina, e o relatório final é gerado relendo
+        # o arquivo — o pico de memória não cresce com o lote.
+        self.saida_ndjson = os.path.splitext(self.saida_arquivo)[0] + '.ndjson'
+
+    def ler_ndjson(self):
+        """Itera os registros gravados no NDJSON intermediário"""
+        with open(self.saida_ndjson, 'rb') as f:
+            for linha in f:
+                yield orjson.loads(linha)
+
+    def _linha(self, registro):
+        """Monta a linha de um registro na ordem das colunas, com defaults"""
+        return [
+            registro.get(col)
+            or (0 if col in self.CAMPOS_NUMERICOS else '')
+            for col in self.COLUNAS
+        ]
+
+    def _concluir(self, linhas):
+        """Finaliza a escrita: descarta o relatório se nada foi gravado"""
+        if not linhas:
+            os.remove(self.saida_arquivo)
             logging.warning("Nenhum dado válido para gerar relatório")
             return False
-        
+        logging.info("Relatório gerado: %s", self.saida_arquivo)
+        return True
+
+    def gerar_relatorio(self, registros):
+        """Gera o relatório final no formato configurado
+
+        Aceita qualquer iterável de registros (lista ou gerador).
+        """
+        if self.formato == 'csv':
+            return self.gerar_csv(registros)
+        return self.gerar_excel(registros)
+
+    def gerar_csv(self, registros):
+        """Gera relatório final em CSV"""
         try:
-            colunas = [
-                'arquivo', 'numero_nota', 'data_emissao', 
-                'cnpj_prestador', 'nome_prestador',
-                'cnpj_tomador', 'nome_tomador',
-                'valor_total', 'base_calculo', 'iss', 'aliquota_iss',
-                'municipio_prestacao'
-            ]
-            
-            # Garante todas colunas mesmo que vazias
-            df = pd.DataFrame(registros)
-            for col in colunas:
-                if col not in df.columns:
-                    df[col] = None
-            
-            # Ordena colunas e preenche valores nulos
-            df = df[colunas].fillna({
-                'valor_total': 0, 'base_calculo': 0, 'iss': 0, 'aliquota_iss': 0
-            })
-            
-            df.to_excel(self.saida_arquivo, index=False)
-            logging.info(f"Relatório gerado: {self.saida_arquivo}")
-            return True
-        
+            linhas = 0
+            # utf-8-sig para o Excel reconhecer a acentuação ao abrir o CSV
+            with open(self.saida_arquivo, 'w', newline='', encoding='utf-8-sig') as f:
+                escritor = csv.writer(f)
+                escritor.writerow(self.COLUNAS)
+                for registro in registros:
+                    escritor.writerow(self._linha(registro))
+                    linhas += 1
+
+            return self._concluir(linhas)
+
+        except Exception as e:
+            logging.error("Erro ao gerar CSV: %s", e)
+            return False
+
+    def gerar_excel(self, registros):
+        """Gera relatório final em Excel, escrevendo linha a linha"""
+        try:
+            # constant_memory descarta cada linha assim que escrita, sem
+            # montar DataFrame nem reter a planilha inteira em memória.
+            workbook = xlsxwriter.Workbook(
+                self.saida_arquivo, {'constant_memory': True}
+            )
+            try:
+                linhas = 0
+                planilha = workbook.add_worksheet()
+                planilha.write_row(0, 0, self.COLUNAS)
+                for linha, registro in enumerate(registros, 1):
+                    planilha.write_row(linha, 0, self._linha(registro))
+                    linhas = linha
+            finally:
+                workbook.close()
+
+            return self._concluir(linhas)
+
         except Exception as e:
-            logging.error(f"Erro ao gerar Excel: {str(e)}")
+            logging.error("Erro ao gerar Excel: %s", e)
             return False
 
 # ==============================================
-# 5. CONTROLE PRINCIPAL
+# 5. INSTÂNCIAS COMPARTILHADAS
+# ==============================================
+# Construídas no nível do módulo para que cada processo worker do
+# ProcessPoolExecutor as inicialize uma única vez ao importar o módulo.
+PADROES = carregar_padroes()
+PROCESSADOR = ProcessadorPDF(PADROES)
+
+def processar_caminho(caminho_pdf):
+    """Alvo picklável para os workers: só o caminho viaja entre processos
+
+    Enviar PROCESSADOR.processar_pdf ao executor serializaria a instância
+    inteira — e os Pattern do re2, quando presente, não são pickláveis.
+    Uma função de módulo é serializada por referência e cada worker usa o
+    PROCESSADOR do seu próprio processo.
+    """
+    return PROCESSADOR.processar_pdf(caminho_pdf)
+
+# ==============================================
+# 6. CONTROLE PRINCIPAL
 # ==============================================
 def main():
     # 1. Configuração inicial
     config = configurar_ambiente()
-    
-    # 2. Carregar padrões de extração
-    padroes = carregar_padroes()
-    processador = ProcessadorPDF(padroes)
     gerador = GeradorRelatorio(config)
-    
-    # 3. Processar arquivos
-    registros = []
+
+    # 2. Processar arquivos
     try:
-        arquivos = [f for f in os.listdir(config['PASTA_PDFS']) if f.lower().endswith('.pdf')]
-        
-        if not arquivos:
+        # DirEntry já traz nome, caminho e stat em cache: filtra PDFs e
+        # descarta arquivos vazios sem syscalls extras por arquivo.
+        with os.scandir(config['PASTA_PDFS']) as entradas:
+            pdfs = [
+                e for e in entradas
+                if e.is_file()
+                and e.name.lower().endswith('.pdf')
+                and e.stat().st_size > 0
+            ]
+
+        if not pdfs:
             print("⚠️ Nenhum PDF encontrado na pasta de entrada.")
             return
 
-        print(f"🔍 Processando {len(arquivos)} arquivos...")
-        
-        for arquivo in arquivos:
-            caminho = os.path.join(config['PASTA_PDFS'], arquivo)
-            print(f"Processando: {arquivo}")
-            
-            dados = processador.processar_pdf(caminho)
-            if dados:
-                registros.append(dados)
-        
-        # 4. Gerar relatório
-        if gerador.gerar_excel(registros):
+        print(f"🔍 Processando {len(pdfs)} arquivos...")
+
+        arquivos = [e.name for e in pdfs]
+        caminhos = [e.path for e in pdfs]
+
+        # Cache por impressão digital do conteúdo: arquivos byte-idênticos
+        # a execuções anteriores não são reprocessados.
+        caminho_cache = os.path.join(config['SAIDA_DIR'], '.cache.db')
+        with shelve.open(caminho_cache) as cache:
+            hashes = [hash_arquivo(c) for c in caminhos]
+            pendentes = [i for i, h in enumerate(hashes) if h not in cache]
+
+            if pendentes:
+                # Cada PDF é independente: distribui entre processos para
+                # escalar com os núcleos. O fator 1.5 sobressatura a CPU
+                # para esconder pausas de I/O.
+                max_workers = max(1, int((os.cpu_count() or 1) * 1.5))
+                with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                    novos = executor.map(
+                        processar_caminho,
+                        [caminhos[i] for i in pendentes],
+                        chunksize=4
+                    )
+                    for i, dados in zip(pendentes, novos):
+                        if dados:
+                            cache[hashes[i]] = dados
+
+            # Serializa cada registro assim que disponível, em vez de
+            # acumular a lista inteira em memória.
+            with open(gerador.saida_ndjson, 'wb') as saida:
+                for arquivo, h in zip(arquivos, hashes):
+                    print(f"Processado: {arquivo}")
+                    dados = cache.get(h)
+                    if dados:
+                        # Garante o nome atual mesmo se o arquivo foi renomeado
+                        saida.write(orjson.dumps(dict(dados, arquivo=arquivo)) + b"\n")
+
+        # 3. Gerar relatório a partir do NDJSON
+        if gerador.gerar_relatorio(gerador.ler_ndjson()):
             print(f"✅ Relatório gerado com sucesso: {gerador.saida_arquivo}")
             print("\nResumo dos dados:")
-            df = pd.DataFrame(registros)
-            print(df.head().to_string(index=False))
+            # columns= fixa o layout de antemão e pula a inferência de
+            # esquema do construtor padrão sobre a lista de dicts.
+            df = pd.DataFrame.from_records(
+                islice(gerador.ler_ndjson(), 5), columns=gerador.COLUNAS
+            )
+            print(df.to_string(index=False))
         else:
             print("⚠️ Não foi possível gerar o relatório.")
     
     except Exception as e:
         print(f"❌ Erro fatal: {str(e)}")
-        logging.error(f"Erro no processamento principal: {str(e)}")
+        logging.error("Erro no processamento principal: %s", e)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file